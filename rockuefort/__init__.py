@@ -8,8 +8,9 @@ Usage: rockuefort index [--add DIR|--remove DIR]
        rockuefort scan
        rockuefort list [--strip PREFIX] [--prepend PREFIX] [--null]
                        [--shuffle] <playlist>
-       rockuefort (copy|link) [--no-number] [--shuffle]
-                              <playlist> <destination>
+       rockuefort copy [--no-number] [--shuffle] [--yes]
+                       <playlist> <destination>
+       rockuefort link [--no-number] [--shuffle] <playlist> <destination>
        rockuefort render [--shuffle] <playlist> <outfile>
        rockuefort check <playlist>
        rockuefort --help
@@ -23,33 +24,58 @@ Options:
   --reset           Forget previously indexed files
   --shuffle         Randomize the order of the output
   --strip PREFIX    Strip PREFIX from each printed filename
+  --yes             Copy without a dry run or confirmation prompt
 """
-from collections import namedtuple
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 from inspect import iscoroutinefunction
+from operator import attrgetter
 import asyncio
+import gc
 import itertools
 import logging
 import math
+import multiprocessing
 import os
 import pickle
 import random
 import re
 import shlex
-import subprocess
 import sys
 import tempfile
 
 from docopt import docopt
+from tinytag import TinyTag, TinyTagException
 import mutagen
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 
 ACTIONS = {}
+# The audio formats that TinyTag or mutagen (see CacheEntry.from_path()) can
+# read. Video files that mutagen can also read, like .m4v, aren't included.
+AUDIO_EXTENSIONS = """
+    .aac .ac3 .aif .aifc .aiff .ape .asf .dff .dsf .eac3 .flac .m4a .m4b .m4p
+    .m4r .mp2 .mp3 .mp4 .mpc .mpp .oga .ofr .ofs .ogg .opus .spx .tak .tta
+    .wav .wma .wv
+""".split()
 CACHE_PATH = os.path.expanduser("~/.cache/rockuefort/index")
+CACHE_VERSION = 6
+# Starts the cache file, so that it can be checked before unpickling anything
+CACHE_HEADER = b"rockuefort cache %d\n" % CACHE_VERSION
 DIRS_CONFIG_PATH = os.path.expanduser("~/.config/rockuefort/dirs")
+# A playlist line that isn't blank or a comment, without surrounding spaces
+ENTRY_LINE = re.compile(r"^[^\S\n]*([^#\s].*?)[^\S\n]*$", re.MULTILINE)
 KNOWN_OPTIONS = "@|+-"
 PLAYLIST_LOAD_ARGS = "shuffle".split()
 PREFERRED_EXTENSIONS = ".oga .ogg .mp3 .flac".split()
+EXTENSION_RANKS = {ext: rank for rank, ext in enumerate(PREFERRED_EXTENSIONS)}
 TAGS = "title artist album genre composer".split()
 
 
@@ -60,8 +86,9 @@ def main():
     )
 
     args = docopt(__doc__, version="Rockuefort 1.1")
-    func = next(func for action, func in ACTIONS.items() if args[action])
-    return asyncio.run(func(args))
+    for action, func in ACTIONS.items():
+        if args[action]:
+            return asyncio.run(func(args))
 
 
 def action(func):
@@ -87,14 +114,20 @@ async def copy(args):
     files = load_playlist(args["<playlist>"], **playlist_load_args(args))
     with tempfile.TemporaryDirectory() as temp_dir:
         make_links(files, temp_dir, args["--no-number"])
-        logger.info("Performing a dry run of rsync...")
         rsync_args = ["rsync", "--itemize-changes", "--copy-links", "--inplace",
-                      "--size-only", "--delete", "--dirs", "--dry-run",
+                      "--size-only", "--delete", "--dirs",
                       temp_dir + "/", args["<destination>"]]
+        if is_remote_path(args["<destination>"]):
+            # rsync already skips compressing formats like FLAC and MP3, so
+            # this only costs CPU for files that will actually shrink.
+            rsync_args.insert(1, "--compress")
+        if not args["--yes"]:
+            logger.info("Performing a dry run of rsync...")
+            await call(["rsync", "--dry-run", *rsync_args[1:]],
+                       ignore_return_code=True)
+            if not confirm("Proceed with the rsync?"):
+                return
         await call(rsync_args, ignore_return_code=True)
-        if confirm("Proceed with the rsync?"):
-            rsync_args.remove("--dry-run")
-            await call(rsync_args, ignore_return_code=True)
 
 
 @action
@@ -152,7 +185,7 @@ async def render(args):
         max_digits = len(str(len(files)))
         for n, file in enumerate(files, start=1):
             base, _ = os.path.splitext(os.path.basename(file))
-            out = os.path.join(temp_dir, ("{:0%sd}-{}.flac" % max_digits).format(n, base))
+            out = os.path.join(temp_dir, f"{n:0{max_digits}d}-{base}.flac")
 
             if file.gain:
                 volume_options = [
@@ -170,6 +203,9 @@ async def render(args):
                 "--no-clobber",
                 *volume_options,
                 file,
+                # These files are only read back once, by the concatenation
+                # below, so encode them as fast as possible.
+                "--compression", "0",
                 out,
                 *trim,
                 "silence", "1", "0.05", "0.1%", # remove silence at the beginning
@@ -211,42 +247,197 @@ async def render(args):
 
 @action
 async def scan(args):
-    mutable_cache = {}
+    # Entries for files that haven't changed since the last scan are reused
+    # instead of reading their tags again.
+    try:
+        previous = {entry.path: entry
+                    for entry in read_cache_entries(CACHE_PATH)}
+    except (FileNotFoundError, OutdatedCacheError):
+        previous = {}
     # Open the cache file *before* scanning so that we haven't wasted time
-    # scanning if we find out the cache file can't be opened.
-    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    # scanning if we find out the cache file can't be opened. It's written
+    # under a temporary name and only replaces the old cache once the scan
+    # has finished, so a failed scan can't leave a partial cache behind.
+    # If the cache path is a symlink, the file it points to is replaced.
+    cache_path = os.path.realpath(CACHE_PATH)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
     dirs, excludes = load_dirs_config(DIRS_CONFIG_PATH)
-    with open(CACHE_PATH, "wb") as out:
-        for dir in dirs:
-            for base, dirnames, files in os.walk(dir):
-                if base in excludes:
-                    logger.debug("excluding: %s", base)
-                    dirnames[:] = []
-                    continue
-                paths = (os.path.join(base, f) for f in files)
-                for path in paths:
-                    logger.info(path)
-                    try:
-                        entry = CacheEntry.from_path(path)
-                    except UnknownFileFormatError:
-                        logger.debug("skipping: %s", path)
-                    else:
-                        mutable_cache[path] = entry
-        cache = tuple(mutable_cache.values())
-        pickle.dump(cache, out)
+    out = tempfile.NamedTemporaryFile(
+        "wb", buffering=1 << 20, dir=os.path.dirname(cache_path),
+        prefix=".index-", delete=False)
+    try:
+        # The temporary file is only accessible to its owner, so give it the
+        # permissions that open() would have given a new cache file.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(out.fileno(), 0o666 & ~umask)
+        with out:
+            write_cache(out, dirs, excludes, previous)
+        os.replace(out.name, cache_path)
+    except BaseException:
+        os.unlink(out.name)
+        raise
+
+
+class Cache:
+    """The scanned library, with lookup tables built as queries need them
+
+    Each table is built at most once per tag, and only for tags that the
+    playlist actually queries.
+    """
+    # The automaton does Python work for every occurrence of every value,
+    # while find() only does it once per matching entry, so prefetch() only
+    # pays off for a tag with many values. Measured on 50k entries, the
+    # automaton was slower below about 20 values and faster from there on.
+    PREFETCH_MIN_NEEDLES = 20
+
+    def __init__(self, entries=()):
+        # scan() writes entries in no particular order, so sort them to keep
+        # the order of matched files stable from one scan to the next.
+        self.entries = tuple(sorted(entries, key=attrgetter("path")))
+        self._exact = {}
+        self._folded = {}
+        self._found = {}
+        self._haystacks = {}
+
+    def find(self, tag, needle):
+        """Return the set of indices of entries whose tag contains needle
+
+        needle must already be case-folded (see PlaylistEntry.from_string).
+        """
+        try:
+            return self._found[tag, needle]
+        except KeyError:
+            pass
+        if "\0" in needle:
+            # Could match across entries in the haystack, so check each one
+            found = {i for i, string in enumerate(self.folded(tag))
+                       if needle in string}
+        else:
+            # Let str.find() skip from match to match in C, and only do
+            # Python work for the entries that actually match.
+            haystack, starts = self.haystack(tag)
+            found = set()
+            pos = haystack.find(needle)
+            while pos != -1:
+                i = bisect_right(starts, pos) - 1
+                found.add(i)
+                pos = haystack.find(needle, starts[i + 1])
+        self._found[tag, needle] = found
+        return found
+
+    def find_exact(self, tag, value):
+        """Return the set of indices of entries that exactly match value
+
+        A string value matches entries that have it as one of their values for
+        tag, and None matches entries with no values for tag. The lookup table
+        for each tag is built the first time it's needed.
+        """
+        try:
+            index = self._exact[tag]
+        except KeyError:
+            index = self._exact[tag] = defaultdict(set)
+            for i, values in enumerate(map(attrgetter(tag), self.entries)):
+                for v in values:
+                    index[v].add(i)
+                if not values:
+                    index[None].add(i)
+        return index.get(value, set())
+
+    def folded(self, tag):
+        """Return the values of tag for each entry, ready for substring search
+
+        Each entry's values are joined with Snowman characters and case-folded
+        so that substring queries don't have to rebuild them.
+        """
+        try:
+            return self._folded[tag]
+        except KeyError:
+            column = self._folded[tag] = [
+                "\N{SNOWMAN}".join(values).casefold()
+                for values in map(attrgetter(tag), self.entries)
+            ]
+            return column
 
+    def haystack(self, tag):
+        """Return all the folded values of tag as one string, and offsets
 
-class CacheEntry(namedtuple("CacheEntry", ["path"] + TAGS)):
+        The result is (haystack, starts), where haystack is the folded()
+        strings joined with null characters and entry i's string begins at
+        starts[i]. starts has one extra item at the end so that starts[i + 1]
+        is always valid.
+        """
+        try:
+            return self._haystacks[tag]
+        except KeyError:
+            column = self.folded(tag)
+            starts = list(itertools.accumulate(
+                (len(string) + 1 for string in column), initial=0))
+            result = self._haystacks[tag] = ("\0".join(column), starts)
+            return result
+
+    def prefetch(self, queries):
+        """Search for all the substring values in queries at once
+
+        With pyahocorasick installed, this builds one automaton per tag from
+        all of that tag's values and runs it over the tag's haystack in a
+        single pass, rather than one pass for each value. Without it (or for
+        a tag with fewer than PREFETCH_MIN_NEEDLES values), find() searches
+        for each value on demand.
+        """
+        if ahocorasick is None:
+            return
+        needles = defaultdict(set)
+        for query in queries:
+            for tag, needle, exact in query:
+                if (not exact and "\0" not in needle
+                        and (tag, needle) not in self._found):
+                    needles[tag].add(needle)
+        for tag, tag_needles in needles.items():
+            if len(tag_needles) < self.PREFETCH_MIN_NEEDLES:
+                continue
+            automaton = ahocorasick.Automaton()
+            for needle in tag_needles:
+                automaton.add_word(needle, needle)
+            automaton.make_automaton()
+            haystack, starts = self.haystack(tag)
+            found = {needle: set() for needle in tag_needles}
+            for end, needle in automaton.iter(haystack):
+                start = end - len(needle) + 1
+                found[needle].add(bisect_right(starts, start) - 1)
+            for needle, indices in found.items():
+                self._found[tag, needle] = indices
+
+
+class CacheEntry(namedtuple("CacheEntry", ["path", "ext", "stat"] + TAGS)):
     @classmethod
-    def from_path(cls, path):
-        mf = mutagen.File(path, easy=True)
-        if mf:
-            abspath = os.path.abspath(path)
-            info = {tag: mf.get(tag, []) for tag in TAGS}
-            info["path"] = abspath
-            return cls(**info)
-        else:
-            raise UnknownFileFormatError(path)
+    def from_path(cls, path, stat=None):
+        # TinyTag is much faster, but mutagen reads more formats
+        try:
+            tags = read_tags_tinytag(path)
+        except UnknownFileFormatError:
+            tags = read_tags_mutagen(path)
+        # Tuples are smaller than lists, and every empty tag shares ()
+        info = {tag: tuple(values) for tag, values in tags.items()}
+        info["path"] = os.path.abspath(path)
+        # Stored so that filter_extensions() doesn't have to split paths
+        _, info["ext"] = os.path.splitext(path)
+        info["stat"] = stat
+        return cls(**info)
+
+    @property
+    def base(self):
+        """The path without its extension"""
+        return self.path[:len(self.path) - len(self.ext)]
+
+    def interned(self):
+        """Return a copy of this entry with its tag values interned
+
+        The same artist, album, and genre names are repeated across many
+        files, so interning lets all the equal values share one string.
+        """
+        return self._replace(**{tag: tuple(map(sys.intern, getattr(self, tag)))
+                                for tag in TAGS})
 
 
 class FileWrapper(str):
@@ -269,7 +460,7 @@ class GroupedMatchResult(MatchResult):
     pass
 
 
-class PlaylistEntry(namedtuple("PlaylistEntry", "query count options crop")):
+class PlaylistEntry(namedtuple("PlaylistEntry", "query count options crop text")):
     _matcher = re.compile(
         r"""(?P<options>[^\w]+)?
             (?:(?P<count>[\d]+):)?
@@ -280,26 +471,57 @@ class PlaylistEntry(namedtuple("PlaylistEntry", "query count options crop")):
         re.VERBOSE).fullmatch
 
     @classmethod
+    @lru_cache(maxsize=4096)
     def from_string(cls, string):
+        # Cached, so the query is a tuple to keep shared instances immutable
         match = cls._matcher(string)
         if match:
             query_str, count, options = match.group("query", "count", "options")
             count = int(count) if count is not None else 1
-            query_parts = [part.split("=", maxsplit=1)  for part in query_str.split("|")]
-            query = [(tag, value) for tag, value in query_parts if tag != "crop"]
-            if not all(tag in TAGS for tag, _ in query):
+            # (tag, value) pairs; the regex guarantees each part has an "="
+            query_parts = [part.partition("=")[::2]
+                           for part in query_str.split("|")]
+            query = tuple(parse_query_part(tag, value)
+                          for tag, value in query_parts if tag != "crop")
+            if not all(tag in TAGS for tag, _, _ in query):
                 raise QueryInvalidTagError
             crop = next((value for tag, value in query_parts if tag == "crop"), None)
             options = options or ''
-            unknown_options = set(options) - set(KNOWN_OPTIONS)
-            if unknown_options:
-                logger.warn("Ignoring unknown query options %r",
-                            "".join(unknown_options))
-            return cls(query, count, options, crop)
+            return cls(query, count, options, crop, query_str)
         else:
             raise QueryParseError
 
 
+class RecordWriter:
+    """Write objects to a file in batches, for reading by iter_records()
+
+    Each batch of up to BATCH_SIZE records is pickled as one list, so a
+    string that appears in several records of a batch (usually an artist or
+    album name) is written once and comes back as a single shared object.
+    Every batch is a separate pickle, which keeps memory use bounded while
+    writing and reading. Call flush() after the last record.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, f):
+        self._f = f
+        self._batch = []
+
+    def flush(self):
+        if self._batch:
+            pickle.dump(self._batch, self._f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._batch = []
+
+    def write(self, obj):
+        self._batch.append(obj)
+        if len(self._batch) >= self.BATCH_SIZE:
+            self.flush()
+
+
+class OutdatedCacheError(Exception):
+    pass
+
+
 class QueryInvalidTagError(Exception):
     pass
 
@@ -330,16 +552,91 @@ def confirm(question):
             return False
 
 
-def filter_extensions(files):
-    extensions = {}
-    for file in files:
-        base, ext = os.path.splitext(file)
-        extensions.setdefault(base, []).append(ext)
-    deduped = []
-    for base, exts in extensions.items():
-        ext = next((e for e in PREFERRED_EXTENSIONS if e in exts), exts[0])
-        deduped.append(base + ext)
-    return deduped
+def filter_extensions(entries):
+    """Return the paths of entries, preferring one extension per base name"""
+    # Usually no two entries share a base, so check for that before doing
+    # any grouping.
+    seen = set()
+    for entry in entries:
+        base = entry.base
+        if base in seen:
+            break
+        seen.add(base)
+    else:
+        return [entry.path for entry in entries]
+    # Keep the best-ranked entry for each base. Extensions not in
+    # PREFERRED_EXTENSIONS tie, and ties keep the first one seen.
+    unranked = len(PREFERRED_EXTENSIONS)
+    best = {}
+    for entry in entries:
+        rank = EXTENSION_RANKS.get(entry.ext, unranked)
+        base = entry.base
+        current = best.get(base)
+        if current is None or rank < current[0]:
+            best[base] = (rank, entry.path)
+    return [path for _, path in best.values()]
+
+
+def find_music_files(dirs, excludes):
+    """Yield (path, stat result) for each music file in dirs, recursively
+
+    Directories in excludes and hidden directories (.git, .Trash, etc.) are
+    skipped. Several directories are listed (and their files stat'ed) at
+    once by a small thread pool, which helps most on network filesystems
+    where each call waits on a round trip. Files come out in no particular
+    order.
+    """
+    def list_dir(dir):
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    # Like os.walk, don't follow symlinks to directories
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not entry.name.startswith("."):
+                            subdirs.append(entry.path)
+                    # Skip cover art, cue sheets, etc. without handing them
+                    # to the tag reader at all.
+                    elif is_audio_file(entry.name):
+                        try:
+                            files.append((entry.path, entry.stat()))
+                        except OSError as e:
+                            logger.debug("skipping: %s (%s)", entry.path, e)
+        except OSError as e:
+            logger.debug("can't list: %s (%s)", dir, e)
+        return subdirs, files
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        pending = set()
+        queue = list(dirs)
+        while queue or pending:
+            for dir in queue:
+                if dir in excludes:
+                    logger.debug("excluding: %s", dir)
+                else:
+                    pending.add(executor.submit(list_dir, dir))
+            queue = []
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, files = future.result()
+                queue.extend(subdirs)
+                yield from files
+
+
+def parse_query_part(tag, value):
+    """Return (tag, value, exact) with value prepared for searching
+
+    An empty value becomes None, meaning the tag has no values, and a value
+    surrounded by double quotes has them removed; both are exact. Anything
+    else is a substring search, so it's case-folded here once rather than
+    every time it's matched.
+    """
+    if value == "":
+        return tag, None, True
+    if value.startswith('"') and value.endswith('"'):
+        return tag, value[1:-1], True
+    return tag, value.casefold(), False
 
 
 def playlist_load_args(args):
@@ -351,7 +648,8 @@ def playlist_load_args(args):
     return load_args
 
 
-def get_results(entries, cache=None):
+def get_results(entries, cache):
+    cache.prefetch(entry.query for entry in entries)
     results = []
     for entry in entries:
         matched_files = filter_extensions(match_files(entry.query, cache))
@@ -359,7 +657,7 @@ def get_results(entries, cache=None):
         if n != entry.count:
             file_info = "".join("\n  match: %s" % f for f in matched_files)
             logger.warn("Matched %s files (expected %s): %r%s",
-                        n, entry.count, entry.query, file_info)
+                        n, entry.count, entry.text, file_info)
         volume_adjustment = entry.options.count('+') - entry.options.count('-')
         options = {}
         if volume_adjustment:
@@ -383,13 +681,47 @@ def get_results(entries, cache=None):
     return results
 
 
+def is_audio_file(filename):
+    """Return whether filename looks like a music file worth reading tags from
+
+    Hidden files are skipped too, which catches the "._" metadata files that
+    macOS leaves next to every track on non-Apple filesystems.
+    """
+    if filename.startswith("."):
+        return False
+    _, ext = os.path.splitext(filename)
+    return ext.lower() in AUDIO_EXTENSIONS
+
+
+def is_remote_path(path):
+    """Return whether rsync will treat path as being on another host"""
+    if path.startswith("rsync://"):
+        return True
+    host, sep, _ = path.partition(":")
+    return bool(sep) and "/" not in host
+
+
+def iter_records(f):
+    """Yield each object that was written to f by a RecordWriter"""
+    # Each batch is its own pickle, so it needs its own Unpickler; sharing
+    # one would resolve a batch's references against an earlier batch's memo.
+    while True:
+        try:
+            batch = pickle.load(f)
+        except EOFError:
+            return
+        yield from batch
+
+
 def load_cache(path):
     try:
-        with open(path, "rb") as f:
-            return pickle.load(f)
+        return Cache(read_cache_entries(path))
     except FileNotFoundError:
         logger.warn("No cache file found. You should run `rockuefort scan`.")
-        return Cache()
+    except OutdatedCacheError:
+        logger.warn("Cache file is outdated or damaged. "
+                    "You should run `rockuefort scan`.")
+    return Cache()
 
 
 def load_dirs_config(path):
@@ -412,7 +744,7 @@ def load_dirs_config(path):
 def load_playlist(path, *, shuffle=False):
     cache = load_cache(CACHE_PATH)
     with open(path) as f:
-        entries = parse_entries(f)
+        entries = parse_entries(f.read())
     results = get_results(entries, cache)
     if shuffle:
         results = shuffled(results)
@@ -421,47 +753,49 @@ def load_playlist(path, *, shuffle=False):
 
 def make_links(targets, dest_dir, no_number=False):
     digits = len(str(len(targets)))
-    for i, target in enumerate(targets, 1):
-        basename = os.path.basename(target)
-        if not no_number:
-            basename = ("{:0%d}-{}" % digits).format(i, basename)
-        dest = os.path.join(dest_dir, basename)
-        try:
-            os.symlink(target, dest)
-        except FileExistsError:
-            logger.warn("File exists: %s", dest)
+    dir_fd = os.open(dest_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for i, target in enumerate(targets, 1):
+            name = target.rpartition(os.sep)[2]
+            if not no_number:
+                name = f"{i:0{digits}d}-{name}"
+            try:
+                os.symlink(target, name, dir_fd=dir_fd)
+            except FileExistsError:
+                logger.warn("File exists: %s", os.path.join(dest_dir, name))
+    finally:
+        os.close(dir_fd)
 
 
 def match_files(query, cache):
-    matched_files = cache
-    for attr, value in query:
-        matched_files = [x for x in matched_files
-                           if matches(value, getattr(x, attr))]
-    return [x.path for x in matched_files]
-
-
-def matches(value, attr_list):
-    """Return whether value matches the attribute described by attr_list
+    """Return the cache entries matching every part of query
 
-    Attributes come from mutagen as lists of strings (except for the "path"
-    attribute). If the value is surrounded by double quotes, we look for exact
-    matches; otherwise, we join together the attribute list with Snowman
-    characters and then do a substring match against the joined string.
+    Exact and empty values are looked up with Cache.find_exact(). Any other
+    value is matched case-insensitively as a substring of the attribute's
+    values joined together with Snowman characters (see Cache.find()).
     """
-    if value == "":
-        return len(attr_list) == 0
-    if value.startswith('"') and value.endswith('"'):
-        return value[1:-1] in attr_list
-    combined_attr_values = "\N{SNOWMAN}".join(attr_list).lower()
-    return value.lower() in combined_attr_values
+    matched = None
+    for attr, value, exact in query:
+        if exact:
+            found = cache.find_exact(attr, value)
+        else:
+            found = cache.find(attr, value)
+        matched = found if matched is None else matched & found
+    if matched is None:
+        return list(cache.entries)
+    return [cache.entries[i] for i in sorted(matched)]
 
 
-def parse_entries(lines):
+def parse_entries(text):
     entries = []
-    for line_number, line in enumerate(lines, start=1):
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
+    # Let the regex skip blank lines and comments; line numbers are only
+    # needed for warnings, so count them between matches.
+    line_number = 1
+    pos = 0
+    for match in ENTRY_LINE.finditer(text):
+        line_number += text.count("\n", pos, match.start())
+        pos = match.start()
+        line = match.group(1)
         try:
             entry = PlaylistEntry.from_string(line)
         except QueryInvalidTagError:
@@ -471,10 +805,90 @@ def parse_entries(lines):
             logger.warn("Ignoring invalid query [line %s]: %r",
                         line_number, line)
         else:
+            # Checked here rather than in from_string(), which is cached, so
+            # that a repeated line is warned about every time
+            unknown_options = set(entry.options) - set(KNOWN_OPTIONS)
+            if unknown_options:
+                logger.warn("Ignoring unknown query options %r",
+                            "".join(unknown_options))
             entries.append(entry)
     return entries
 
 
+def read_cache_entries(path):
+    # Loading creates a lot of small objects, none of which can be garbage
+    # yet, so pause the cyclic collector instead of letting it repeatedly
+    # traverse them.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, "rb") as f:
+            # Checked before unpickling, because an older cache's records may
+            # not even unpickle into the current CacheEntry
+            if f.read(len(CACHE_HEADER)) != CACHE_HEADER:
+                raise OutdatedCacheError(path)
+            try:
+                return tuple(iter_records(f))
+            except (AttributeError, EOFError, TypeError, ValueError,
+                    pickle.UnpicklingError) as e:
+                # The file is damaged (e.g., truncated), so rescan it too
+                raise OutdatedCacheError(path) from e
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def read_entry(path_and_stat):
+    """Return (path, CacheEntry), with None as the entry for non-music files
+
+    This runs in scan()'s worker processes, so it avoids raising for the
+    common case of non-music files, and it returns the path because results
+    come back out of order.
+    """
+    path, stat = path_and_stat
+    try:
+        return path, CacheEntry.from_path(path, stat)
+    except UnknownFileFormatError:
+        return path, None
+
+
+def read_tags_mutagen(path):
+    try:
+        mf = mutagen.File(path, easy=True)
+    except (OSError, mutagen.MutagenError):
+        raise UnknownFileFormatError(path)
+    if not mf:
+        raise UnknownFileFormatError(path)
+    return {tag: mf.get(tag, []) for tag in TAGS}
+
+
+def read_tags_tinytag(path):
+    """Read tags with TinyTag, returning lists like mutagen does
+
+    TinyTag exposes the first value of each tag as an attribute and puts any
+    additional values (e.g., a second artist) in the "other" dict.
+
+    TinyTag doesn't support every format mutagen does, and it accepts some
+    files that aren't really audio as long as they have the right extension,
+    so UnknownFileFormatError is raised for files it can't read or that have
+    no tags at all. CacheEntry.from_path() lets mutagen decide about those.
+    """
+    try:
+        tt = TinyTag.get(path, tags=True, duration=False, image=False)
+    except (OSError, TinyTagException):
+        raise UnknownFileFormatError(path)
+    other = tt.other
+    info = {}
+    for tag in TAGS:
+        value = getattr(tt, tag, None)
+        values = [value] if value else []
+        values.extend(v for v in other.get(tag, []) if v)
+        info[tag] = values
+    if not any(info.values()):
+        raise UnknownFileFormatError(path)
+    return info
+
+
 def shuffled(results):
     fixed = []
     non_fixed = []
@@ -487,3 +901,46 @@ def shuffled(results):
     for position, result in fixed:
         non_fixed.insert(position, result)
     return non_fixed
+
+
+def write_cache(f, dirs, excludes, previous):
+    """Scan dirs and write a cache entry for each music file to f
+
+    previous maps paths to their entries from the last scan. Those entries
+    are written again as they are if their files haven't changed.
+    """
+    f.write(CACHE_HEADER)
+    writer = RecordWriter(f)
+    seen_paths = set()
+    to_read = []
+    for path, st in find_music_files(dirs, excludes):
+        abspath = os.path.abspath(path)
+        if abspath in seen_paths:
+            continue
+        seen_paths.add(abspath)
+        stat = (st.st_size, st.st_mtime_ns)
+        entry = previous.get(abspath)
+        if entry is not None and entry.stat == stat:
+            logger.debug("unchanged: %s", path)
+            # Entries aren't interned when they're loaded, because that
+            # would slow down every load; intern them here instead.
+            writer.write(entry.interned())
+        else:
+            to_read.append((path, stat))
+    # Reading tags is CPU-bound, so spread it across processes. Rescanning
+    # an unchanged library leaves nothing to read, so don't start any then.
+    if to_read:
+        with multiprocessing.Pool() as pool:
+            # Results are written in whatever order the workers finish them;
+            # Cache sorts the entries when the cache is loaded.
+            results = pool.imap_unordered(read_entry, to_read, chunksize=64)
+            for path, entry in results:
+                if entry is None:
+                    logger.debug("skipping: %s", path)
+                else:
+                    logger.info(path)
+                    # Write entries as they arrive rather than holding the
+                    # whole library in memory. Interning lets their tag
+                    # values share pickled strings with nearby entries.
+                    writer.write(entry.interned())
+    writer.flush()
@@ -7,9 +7,13 @@ setup(
             'rockuefort=rockuefort:main',
         ],
     },
+    extras_require={
+        'fast': ['pyahocorasick >=1.4'],
+    },
     install_requires=[
         'docopt >=0.6.1',
         'mutagen >=1.27',
+        'tinytag >=2.0',
     ],
     license='MIT',
     name='rockuefort',